@@ -1,2 +1,2 @@
-from .closablequeue import ClosableQueue  # noqa
+from .closablequeue import ClosableQueue, ClosablePriorityQueue  # noqa
 from .pipeline import Pipeline, worker, forward_input  # noqa
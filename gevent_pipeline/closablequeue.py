@@ -1,6 +1,7 @@
-import random
-import gevent
+import heapq
+from collections import deque
 from gevent import queue
+from itertools import islice
 
 
 class ClosableQueue(queue.Queue):
@@ -20,39 +21,16 @@ class ClosableQueue(queue.Queue):
         >>> q.get() is StopIteration
         True
     """
-    _closed = False
+    __slots__ = ('_closed',)
 
-    def __init__(self, *args, fuzz=None, **kwargs):
-        self._fuzz_factor = fuzz
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-
-    def _fuzz(self):
-        """
-        Wait random amount of time
-        used in hopes of increasing chance to break tests
-        """
-        if self._fuzz_factor is not None:
-            gevent.sleep(random.uniform(0, self._fuzz_factor))
+        self._closed = False
 
     @property
     def closed(self):
         return self._closed
 
-    def _unstick(self):
-        """
-        Unstick all blocking getters
-        """
-        if not self._closed:
-            raise RuntimeError("Don't start unsticking before closing")
-
-        gevent.sleep()
-        while len(self.getters) > len(self.putters):
-            gevent.sleep()
-            try:
-                super().put(StopIteration, block=False)
-            except queue.Full:
-                pass
-
     def close(self, once=True):
         """
         Close the queue
@@ -60,29 +38,198 @@ class ClosableQueue(queue.Queue):
         Arguments:
             once(bool): Raise error if closing closed queue
         """
-        self._fuzz()
         if once and self._closed:
             raise RuntimeError("Tried closing already closed queue")
 
         self._closed = True
-        gevent.spawn(self._unstick)
 
-    def put(self, item, *args, **kwargs):
+        # Unstick all blocking getters once the queue runs dry (see _unlock),
+        # later getters see the queue is closed
+        if self.getters:
+            self._schedule_unlock()
+
+    def _unlock(self):
+        super()._unlock()
+
+        # Getters still blocking on a closed, empty queue get StopIteration from _get,
+        # nobody can put to a closed queue so the loop ends
+        while self._closed and self.getters:
+            getter = self.getters.popleft()
+            getter.switch(getter)
+
+    def _get(self):
+        # The queue is only empty here for getters unstuck by _unlock
+        return self.queue.popleft() if self.queue else StopIteration
+
+    def put(self, item, block=True, timeout=None):
+        if self._closed:
+            raise RuntimeError("Cannot put to a closed queue")
+
+        return super().put(item, block, timeout)
+
+    def put_many(self, items):
+        """
+        Put all of `items`, waking up getters once instead of once per item
+
+        Items that do not fit in the queue block like `.put(item)` would.
+        """
         if self._closed:
             raise RuntimeError("Cannot put to a closed queue")
 
-        result = super().put(item, *args, **kwargs)
-        kwargs.get('block', True) and self._fuzz()
-        return result
+        items = iter(items)
+        if not self.putters:
+            # Fill the free slots directly, gevent will not switch greenlets in between
+            n_free = None if self.maxsize is None else max(0, self.maxsize - self.qsize())
+            self._put_many(islice(items, n_free))
+
+            if self.getters:
+                self._schedule_unlock()
+
+        for item in items:
+            self.put(item)
+
+    def _put_many(self, items):
+        for item in items:
+            self._put(item)
 
-    def get(self, *args, **kwargs):
+    def swap_in(self, items):
+        """
+        Hand items to the queue in one go, ignoring maxsize
+
+        Meant for workers that already hold all of their output,
+        if the queue is empty a deque of items becomes its storage without copying.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot put to a closed queue")
+
+        if self.qsize():
+            self.queue.extend(items)
+        else:
+            self.queue = items if isinstance(items, deque) else deque(items)
+
+        if self.getters:
+            self._schedule_unlock()
+
+    def get(self, block=True, timeout=None):
         if not self._closed:
-            item = super().get(*args, **kwargs)
-            kwargs.get('block', True) and self._fuzz()
-            return item
-
-        try:
-            # Note: cannot use super().get_nowait here as that will just call this function again
-            return super().get(block=False)
-        except queue.Empty:
+            return super().get(block, timeout)
+
+        # Checking beforehand saves raising queue.Empty at the end of every stream
+        if not self.qsize():
             return StopIteration
+
+        # Note: cannot use super().get_nowait here as that will just call this function again
+        return super().get(block=False)
+
+    def get_many(self, max_n=None):
+        """
+        Get up to `max_n` items at once (no limit if None)
+
+        Blocks like `.get()` until an item is available, then takes whatever else
+        is already in the queue.
+
+        Returns: list of items, or StopIteration once closed and exhausted
+        """
+        item = self.get()
+        if item is StopIteration:
+            return StopIteration
+
+        items = [item]
+        while (max_n is None or len(items) < max_n) and self.qsize():
+            # A StopIteration put to the queue ends the stream, leave it for the next get
+            if self._peek() is StopIteration:
+                break
+            items.append(self._get())
+
+        if self.putters:
+            self._schedule_unlock()
+
+        return items
+
+
+class ClosablePriorityQueue(ClosableQueue, queue.PriorityQueue):
+    """
+    Acts like `gevent.queue.PriorityQueue` but closable like `ClosableQueue`
+
+    Example:
+        >>> q = ClosablePriorityQueue()
+        >>> q.put_many([3, 1, 2])
+        >>> q.get()
+        1
+        >>> q.close()
+        >>> q.drain_sorted()
+        [2, 3]
+        >>> q.get() is StopIteration
+        True
+    """
+    __slots__ = ('_n_stop',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._n_stop = 0
+
+    # StopIteration cannot be ordered against the items,
+    # so it is counted beside the heap and handed out once the heap is empty
+
+    def _qsize(self):
+        return len(self.queue) + self._n_stop
+
+    def _put(self, item):
+        if item is StopIteration:
+            self._n_stop += 1
+        else:
+            super()._put(item)
+
+    def _get(self):
+        if self.queue:
+            return heapq.heappop(self.queue)
+
+        if self._n_stop:
+            self._n_stop -= 1
+        return StopIteration
+
+    def _peek(self):
+        return self.queue[0] if self.queue else StopIteration
+
+    def _put_many(self, items):
+        batch = list(items)
+        items = [item for item in batch if item is not StopIteration]
+        self._n_stop += len(batch) - len(items)
+
+        if len(items) >= len(self.queue):
+            # Building the heap in one go is cheaper than pushing each item
+            self.queue.extend(items)
+            heapq.heapify(self.queue)
+        else:
+            # Heapifying would redo the whole heap for a handful of items
+            for item in items:
+                self._put(item)
+
+    def swap_in(self, items):
+        """
+        Hand items to the queue in one go, ignoring maxsize
+        """
+        if self._closed:
+            raise RuntimeError("Cannot put to a closed queue")
+
+        self._put_many(items)
+
+        if self.getters:
+            self._schedule_unlock()
+
+    def drain_sorted(self):
+        """
+        Take everything left in a closed queue at once
+
+        Returns: list of the remaining items in priority order
+        """
+        if not self._closed:
+            raise RuntimeError("Can only drain a closed queue")
+
+        items = sorted(self.queue)
+        del self.queue[:]
+
+        if self.putters:
+            self._schedule_unlock()
+
+        return items
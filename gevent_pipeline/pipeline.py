@@ -1,7 +1,8 @@
 import gevent
-from gevent import queue
 from functools import partial
-from collections import namedtuple
+from collections import deque, namedtuple
+from gevent.lock import Semaphore
+from itertools import chain, islice
 
 from .closablequeue import ClosableQueue
 
@@ -29,32 +30,173 @@ def raise_(wec):
     raise
 
 
-def sorter(q_in, q_out, q_done, key=None, reverse=False):
+def _until_stop(get):
+    """
+    Iterate over the results of calling `get` until it returns StopIteration
+
+    Unlike `iter(get, StopIteration)` checks with `is`,
+    so items are never compared to StopIteration with their own `__eq__`
+    """
+    while True:
+        item = get()
+        if item is StopIteration:
+            return
+        yield item
+
+
+def _batches(q_in, batch_size):
+    """
+    Iterate over lists of at most `batch_size` items from q_in until it is exhausted
+    """
+    return _until_stop(partial(q_in.get_many, batch_size))
+
+
+def _inputs(q_in, batch_size):
+    """
+    Iterate over items from q_in, getting `batch_size` at a time
+    """
+    if batch_size == 1:
+        return _until_stop(q_in.get)
+    return chain.from_iterable(_batches(q_in, batch_size))
+
+
+def sorter(q_in, q_out, key=None, reverse=False, shard_size=4096):
     """
     Worker that sorts incoming data
 
+    Shards of `shard_size` items are sorted as they arrive, while upstream is busy,
+    leaving the final sort little more than merging the sorted runs.
+
     Warning:
-        Will completely exhaust input queue before forwarding to output
+        Will completely exhaust input queue before forwarding to output,
+        everything is then handed over at once regardless of the output maxsize
     """
-    for value in sorted(q_in, key=key, reverse=reverse):
-        q_out.put(value)
+    items, shard = [], []
+    for batch in _batches(q_in, None):
+        shard.extend(batch)
+        if len(shard) >= shard_size:
+            shard.sort(key=key, reverse=reverse)
+            items.extend(shard)
+            shard = []
+    items.extend(shard)
 
-    # Signal done
-    q_done.put(None)
+    # Sorting is stable, so sorting the shards first does not change the result
+    items.sort(key=key, reverse=reverse)
+    q_out.swap_in(deque(items))
 
 
-def filterer(condition, q_in, q_out, q_done):
+def filterer(condition, q_in, q_out, batch_size=1):
     """
     Puts items from q_in to q_out if `condition(item)`
     """
-    for item in q_in:
-        if condition(item):
-            q_out.put(item)
+    if batch_size == 1:
+        put = q_out.put
+        for item in _until_stop(q_in.get):
+            if condition(item):
+                put(item)
+    else:
+        for batch in _batches(q_in, batch_size):
+            q_out.put_many([item for item in batch if condition(item)])
+
+
+def _run_worker(f, q_in, q_out, exception_handler, discard_none):
+    """
+    Worker loop, passes exceptions to exception_handler
+    """
+    # Bound once instead of looking up q_out.put per item
+    put = q_out.put if q_out is not None else None
+    for input_ in _until_stop(q_in.get):
+        try:
+            out = f(input_)
+        except Exception as exc:
+            wec = WorkerExceptionContext(input_, exc, q_out)
+            exception_handler(wec)
+            continue
+
+        if discard_none and out is None:
+            continue
+
+        if put is not None:
+            put(out)
+
+
+def _run_batched(f, q_in, q_out, exception_handler, discard_none, batch_size):
+    """
+    Worker loop taking batches from q_in and putting each batch of results at once
+    """
+    put_many = q_out.put_many if q_out is not None else None
+    for batch in _batches(q_in, batch_size):
+        results = []
+        try:
+            for input_ in batch:
+                try:
+                    out = f(input_)
+                except Exception as exc:
+                    wec = WorkerExceptionContext(input_, exc, q_out)
+                    exception_handler(wec)
+                    continue
+
+                if discard_none and out is None:
+                    continue
+
+                results.append(out)
+        finally:
+            # Forward what is done even if the exception handler raised
+            if put_many is not None and results:
+                put_many(results)
+
+
+# Loops for the raise_ exception handler, which would only re-raise,
+# so exceptions propagate without a try block
+
+def _run_forwarding(f, q_in, q_out):
+    """
+    Worker loop forwarding every result
+    """
+    put = q_out.put
+    for input_ in _until_stop(q_in.get):
+        put(f(input_))
 
-    q_done.put(None)
+
+def _run_discarding(f, q_in, q_out):
+    """
+    Worker loop forwarding results that are not None
+    """
+    put = q_out.put
+    for input_ in _until_stop(q_in.get):
+        out = f(input_)
+        if out is not None:
+            put(out)
 
 
-def worker(exception_handler=raise_, discard_none=False):
+def _run_draining(f, q_in, q_out=None):
+    """
+    Worker loop without output
+    """
+    for input_ in _until_stop(q_in.get):
+        f(input_)
+
+
+def _worker_loop(exception_handler, discard_none, batch_size, has_output):
+    """
+    Pick the worker loop specialized for the given configuration
+
+    Returns: callable taking (f, q_in, q_out)
+    """
+    if batch_size != 1:
+        return partial(_run_batched, exception_handler=exception_handler,
+                       discard_none=discard_none, batch_size=batch_size)
+
+    if exception_handler is not raise_:
+        return partial(_run_worker, exception_handler=exception_handler, discard_none=discard_none)
+
+    if not has_output:
+        return _run_draining
+
+    return _run_discarding if discard_none else _run_forwarding
+
+
+def worker(exception_handler=raise_, discard_none=False, batch_size=1):
     """
     Wraps a function to become a suitable worker for Pipeline
 
@@ -64,40 +206,85 @@ def worker(exception_handler=raise_, discard_none=False):
         exception_handler(callable):
             Called when an exception occurs during function evaluation
         discard_none(bool): Do not forward None results to output queue
+        batch_size(int):
+            Take up to this many items from q_in at once and forward their results together.
+            Saves queue operations, but a batch is worked through by a single greenlet,
+            and if the exception handler raises the rest of the batch is dropped.
 
     """
 
-    def inner(f, q_in, q_out=None):
-        for input_ in q_in:
-            try:
-                out = f(input_)
-            except Exception as exc:
-                wec = WorkerExceptionContext(input_, exc, q_out)
-                exception_handler(wec)
-                continue
-
-            if discard_none and out is None:
-                continue
-
-            if q_out is not None:
-                q_out.put(out)
-
     def decorator(f):
-        def outer(q_in, q_out=None, q_done=None):
-            try:
-                inner(f, q_in, q_out=q_out)
-            finally:
-                if q_done is not None:
-                    q_done.put(None)
+        def outer(q_in, q_out=None):
+            loop = _worker_loop(exception_handler, discard_none, batch_size, q_out is not None)
+            loop(f, q_in, q_out)
 
         outer.__name__ = f.__name__
         outer.__doc__ = "[Worker wrapped]\n{}".format(f.__doc__)
         outer.f = f
-        return outer
+        return _reads_iter_queue(outer)
 
     return decorator
 
 
+class _IterQueue:
+    """
+    Input for the layer after `from_iter`, getting items straight from an iterator
+
+    Only has `.get()`, `.get_many()` and iteration, which is all the worker loops
+    of this module use, see `_reads_iter_queue`.
+
+    Getting from the iterator may switch greenlets (e.g. a generator doing IO)
+    so greenlets take turns, the semaphore is only used when one has to wait.
+    """
+
+    def __init__(self, iter_):
+        self._iter = iter(iter_)
+        self._busy = False
+        self._n_waiting = 0
+        self._turn = Semaphore(0)
+
+    def _enter(self):
+        if self._busy:
+            self._n_waiting += 1
+            self._turn.acquire()
+        else:
+            self._busy = True
+
+    def _leave(self):
+        if self._n_waiting:
+            # Hand the turn straight to a waiting greenlet
+            self._n_waiting -= 1
+            self._turn.release()
+        else:
+            self._busy = False
+
+    def get(self):
+        self._enter()
+        try:
+            return next(self._iter, StopIteration)
+        finally:
+            self._leave()
+
+    def get_many(self, max_n=None):
+        self._enter()
+        try:
+            items = list(islice(self._iter, max_n))
+        finally:
+            self._leave()
+        return items or StopIteration
+
+    def __iter__(self):
+        return _until_stop(self.get)
+
+
+def _reads_iter_queue(f):
+    """
+    Mark worker f as only using `.get()` and `.get_many()` of q_in, so it can read from an `_IterQueue`
+    """
+    f.reads_iter_queue = True
+    return f
+
+
 _unset = object()
 
 
@@ -133,10 +320,9 @@ class Pipeline:
     ... def double(x):
     ...     return 2 * x
     ...
-    >>> def load_numbers(q_in, q_out, q_done):
+    >>> def load_numbers(q_in, q_out):
     ...     for i in range(100):
     ...         q_out.put(i)
-    ...     q_done.put(None)
     ...
     >>> q_out = ClosableQueue()
     >>> p = Pipeline()\\
@@ -157,12 +343,16 @@ class Pipeline:
     [2, 1, 4, 0, 3, 5, 8, 6, 7, 9]
     """
 
+    #: Output queues created by chain_workers hold this many items per worker (at least 64),
+    #: deeper buffers mean workers block on full or empty queues less often
+    default_slack = 16
+
     def __init__(self, q_in=None):
         """
         q_in: First input queue
         """
         self.q_out_prev = q_in
-        self._greenlets = []
+        self._greenlets = set()
 
     def __iter__(self):
         q_out = self.q_out_prev
@@ -176,32 +366,35 @@ class Pipeline:
         yield from q_out
 
     @staticmethod
-    def _queue_closer(q_out, q_start, q_done):
+    def _run_and_close(f, q_in, q_out, remaining):
         """
-        Close q_out after q_start is exhausted
-        Calls get on q_done for each item from q_start to keep track
+        Run worker f, the last worker of a layer to finish closes q_out
 
-        Used to close queue after all workers are done
+        `remaining` is a single item list counting the running workers of the layer,
+        greenlets only switch on IO so it needs no lock
         """
-        for _ in q_start:
-            q_done.get()
-
-        if q_out is not None:
-            q_out.close()
+        try:
+            f(q_in, q_out)
+        finally:
+            remaining[0] -= 1
+            if not remaining[0] and q_out is not None:
+                q_out.close()
 
     def _spawn(self, f, *args, **kwargs):
         w = gevent.spawn(f, *args, **kwargs)
-        self._greenlets.append(w)
+        self._greenlets.add(w)
+        # Finished greenlets remove themselves
+        w.rawlink(self._greenlets.discard)
 
     def chain_workers(self, f, n_workers=1, q_out=_unset, maxsize=_unset):
         """
         Chain another set of workers
 
         Worker function conventions (see worker decorator for automation):
-        1. takes three queues as arguments: q_in, q_out and q_done
+        1. takes two queues as arguments: q_in and q_out
         2. gets from q_in until it is exhausted (i.e. .get returns StopIteration)
         3. puts result(s) to q_out
-        4. puts anything to q_done to indicate end of results
+        4. returns to indicate end of results
 
         The output queue from one function will is given as input queue to the next.
 
@@ -214,112 +407,133 @@ class Pipeline:
             f: Worker function
             n_workers: Number of greenlets to spawn
             q_out: Specify manual output queue, if unset creates new
-            maxsize: maxsize of created output queue (default 2 * n_workers)
+            maxsize: maxsize of created output queue (default max(64, default_slack * n_workers))
         """
+        if isinstance(self.q_out_prev, _IterQueue) and not getattr(f, 'reads_iter_queue', False):
+            # Other workers may use the rest of the queue API, so feed them a real queue
+            iter_queue, self.q_out_prev = self.q_out_prev, None
+            self._load(iter_queue._iter)
+
         if q_out is _unset:
-            maxsize = maxsize if maxsize is not _unset else 2 * n_workers
+            maxsize = maxsize if maxsize is not _unset else max(64, self.default_slack * n_workers)
             q_out = ClosableQueue(maxsize=maxsize)
         elif maxsize is not _unset:
             raise ValueError("`maxsize` cannot be set together with `q_out`")
 
-        q_start = queue.Queue()
-        q_done = queue.Queue()
-
-        self._spawn(Pipeline._queue_closer, q_out, q_start, q_done)
-
+        remaining = [n_workers]
         for _ in range(n_workers):
-            q_start.put(None)
-            self._spawn(f, self.q_out_prev, q_out, q_done)
+            self._spawn(Pipeline._run_and_close, f, self.q_out_prev, q_out, remaining)
 
-        q_start.put(StopIteration)
+        # Without workers there is nobody to close q_out, it stays empty
+        if not n_workers and q_out is not None:
+            q_out.close()
 
         self.q_out_prev = q_out
 
         return self
 
-    def from_iter(self, iter_, *args, **kwargs):
+    def from_iter(self, iter_, n_workers=1, q_out=_unset, maxsize=_unset):
         """
         Provide next layer with values from iterator
 
+        Unless an output queue is asked for (`q_out`, `maxsize` or more workers)
+        a next layer of `map`, `filter`, `fold`, `sort` or `worker` decorated functions
+        gets values straight from the iterator, without a loader greenlet and queue in between.
+
+        Arguments: see `chain_workers`
+
         Returns: self
         """
-        def loader(q_in, q_out, q_done):
-            if q_in is not None:
-                raise ValueError("from_iter makes no sense when there is an input queue")
+        if self.q_out_prev is not None:
+            raise ValueError("from_iter makes no sense when there is an input queue")
 
-            try:
-                for value in iter_:
-                    q_out.put(value)
-            finally:
-                q_done.put(None)
+        if n_workers == 1 and q_out is _unset and maxsize is _unset:
+            self.q_out_prev = _IterQueue(iter_)
+            return self
 
-        return self.chain_workers(loader, *args, **kwargs)
+        return self._load(iter_, n_workers=n_workers, q_out=q_out, maxsize=maxsize)
 
-    def filter(self, f, *args, **kwargs):
+    def _load(self, iter_, **kwargs):
+        """
+        Chain workers putting values from iterator to the next layer
+        """
+        def loader(q_in, q_out):
+            for value in iter_:
+                q_out.put(value)
+
+        return self.chain_workers(loader, **kwargs)
+
+    def filter(self, f, *args, batch_size=1, **kwargs):
         """
         Add a filter step, if f(x) is trueish then x will be passed along
         otherwise discarded.
 
+        Arguments:
+            batch_size: see `worker`
+
         Returns: self
         """
-        return self.chain_workers(partial(filterer, f), *args, **kwargs)
+        g = _reads_iter_queue(partial(filterer, f, batch_size=batch_size))
+        return self.chain_workers(g, *args, **kwargs)
 
-    def map(self, f, *args, **kwargs):
+    def map(self, f, *args, batch_size=1, **kwargs):
         """
         Like chain_worker but decorates f with worker() first
 
+        Arguments:
+            batch_size: see `worker`
+
         Returns: self
         """
 
-        g = worker()(f)
+        g = worker(batch_size=batch_size)(f)
         return self.chain_workers(g, *args, **kwargs)
 
-    def fold(self, f, x0, *args, **kwargs):
+    def fold(self, f, x0, *args, batch_size=1, **kwargs):
         """
         Reduce pipe to a single value.
         Will block until done
 
+        Arguments:
+            batch_size: see `worker`
+
         Returns: folded value
         """
-        def g(q_in, q_out, q_done):
+        @_reads_iter_queue
+        def g(q_in, q_out):
             # 0-length protection
             result = q_in.get()
 
             if result is StopIteration:
-                q_done.put(None)
                 return
 
-            try:
-                for v in q_in:
-                    result = f(result, v)
-                q_out.put(result)
-            finally:
-                q_done.put(None)
+            for v in _inputs(q_in, batch_size):
+                result = f(result, v)
+            q_out.put(result)
 
         # Logic:
         # Start reducing with desired number of workers
         # have them dump result on intermediate queue.
-        # Run a final pass with single worker to combine
+        # Combine those in passes with half as many workers each,
+        # then fold what is left onto x0 in the calling greenlet
 
         n_workers = kwargs.pop('n_workers', 1)
-        q_out = kwargs.pop('q_out', ClosableQueue())
-        q_interim = ClosableQueue()
-
-        # Make sure final pass has at least x0
-        q_interim.put(x0)
 
         # Main workload
-        self.chain_workers(g, *args, q_out=q_interim, n_workers=n_workers, **kwargs)
+        self.chain_workers(g, *args, q_out=ClosableQueue(), n_workers=n_workers, **kwargs)
 
-        # Final reduction
-        self.chain_workers(g, *args, q_out=q_out, n_workers=1, **kwargs)
+        # Reduction tree
+        while n_workers > 2:
+            n_workers >>= 1
+            self.chain_workers(g, *args, q_out=ClosableQueue(), n_workers=n_workers, **kwargs)
 
-        result = q_out.get()
-        if q_out.get() is not StopIteration:
-            raise RuntimeError("Unexpected data on fold output channel")
+        # Final reduction
+        result = x0
+        for v in self:
+            result = f(result, v)
         return result
 
-    def sort(self, key=None, reverse=False, maxsize=_unset):
+    def sort(self, key=None, reverse=False, maxsize=_unset, shard_size=4096):
         """
         Sort before passing on to the next stage
 
@@ -337,23 +551,17 @@ class Pipeline:
         Arguments:
             key: Same as builtin `sorted`
             reverse: Same as builtin `sorted`
-            maxsize: Size of output queue
+            maxsize: Size of output queue, does not limit anything as the sorted items are handed over at once
+            shard_size: Number of items sorted at once while waiting for the rest, see `sorter`
         """
-        self.chain_workers(
-            partial(sorter, key=key, reverse=reverse),
+        return self.chain_workers(
+            _reads_iter_queue(partial(sorter, key=key, reverse=reverse, shard_size=shard_size)),
             n_workers=1,
             maxsize=maxsize)
-        return self
 
     def join(self):
         """
         Wait for the greenlets to finish
         Wrapper around gevent.joinall
         """
-
-        done = gevent.joinall(self._greenlets)
-
-        # TODO pass argumetns to .joinall and remove greenlets in done from _greenlets
-        self._greenlets = []
-
-        return done
+        return gevent.joinall(list(self._greenlets))
@@ -0,0 +1,40 @@
+import gevent
+import random
+
+from gevent_pipeline import ClosableQueue
+
+
+class FuzzingClosableQueue(ClosableQueue):
+    """
+    ClosableQueue that waits a random amount of time after each operation,
+    used in hopes of increasing chance to break tests
+
+    Arguments:
+        fuzz(float): Upper bound in seconds of the random wait, None disables it
+    """
+    __slots__ = ('_fuzz_factor',)
+
+    def __init__(self, *args, fuzz=None, **kwargs):
+        self._fuzz_factor = fuzz
+        super().__init__(*args, **kwargs)
+
+    def _fuzz(self):
+        """
+        Wait random amount of time
+        """
+        if self._fuzz_factor is not None:
+            gevent.sleep(random.uniform(0, self._fuzz_factor))
+
+    def close(self, once=True):
+        self._fuzz()
+        super().close(once=once)
+
+    def put(self, item, block=True, timeout=None):
+        result = super().put(item, block, timeout)
+        block and self._fuzz()
+        return result
+
+    def get(self, block=True, timeout=None):
+        item = super().get(block, timeout)
+        block and self._fuzz()
+        return item
@@ -1,9 +1,12 @@
-from gevent_pipeline import ClosableQueue
+from gevent_pipeline import ClosableQueue, ClosablePriorityQueue
+from helpers import FuzzingClosableQueue
 
 import gevent
 from gevent import queue
 
+from collections import Counter, deque
 import functools
+import heapq
 import pytest
 import random
 
@@ -21,7 +24,7 @@ def repeat(n=10):
 
 
 def test_cq_cant_close_twice():
-    cq = ClosableQueue(fuzz=0.01)
+    cq = FuzzingClosableQueue(fuzz=0.01)
     cq.put(1)
     cq.close()
 
@@ -30,14 +33,14 @@ def test_cq_cant_close_twice():
 
 
 def test_cq_stopiteration():
-    cq = ClosableQueue(fuzz=0.01)
+    cq = FuzzingClosableQueue(fuzz=0.01)
     cq.close()
-    assert cq.get() == StopIteration
-    assert cq.get() == StopIteration
+    assert cq.get() is StopIteration
+    assert cq.get() is StopIteration
 
 
 def test_cq_cant_put():
-    cq = ClosableQueue(fuzz=0.01)
+    cq = FuzzingClosableQueue(fuzz=0.01)
     cq.close()
 
     with pytest.raises(RuntimeError):
@@ -45,19 +48,19 @@ def test_cq_cant_put():
 
 
 def test_cq_gets_remaining():
-    cq = ClosableQueue(fuzz=0.01)
+    cq = FuzzingClosableQueue(fuzz=0.01)
 
     for _ in range(5):
         cq.put(1)
 
     cq.close()
 
-    assert 5 == sum(i for i in cq)
+    assert 5 == sum(cq)
 
 
 @repeat()
 def test_cq_getter_unstuck():
-    cq = ClosableQueue(fuzz=0.01)
+    cq = FuzzingClosableQueue(fuzz=0.01)
     trigger_close = queue.Queue()
 
     def blocked_reader():
@@ -88,7 +91,7 @@ def test_cq_racy_get():
     5. - stuck forever
     """
 
-    cq = ClosableQueue(fuzz=0.001)
+    cq = FuzzingClosableQueue(fuzz=0.001)
 
     def closer():
         cq.close()
@@ -113,7 +116,7 @@ def test_cq_racy_put():
     5.  - getter misses out on value
     """
 
-    cq = ClosableQueue(fuzz=0.001)
+    cq = FuzzingClosableQueue(fuzz=0.001)
     q_got = queue.Queue()
     q_put_result = queue.Queue()
 
@@ -160,7 +163,7 @@ def test_cq_maxsize_racy():
     n_getters = random.randint(50, 100)
     n_putters = random.randint(50, 100)
 
-    cq = ClosableQueue(fuzz=0.001, maxsize=maxsize)
+    cq = FuzzingClosableQueue(fuzz=0.001, maxsize=maxsize)
     q_got = queue.Queue()
     q_put_result = queue.Queue()
 
@@ -211,7 +214,7 @@ def test_cq_maxsize_racy():
         value = q_got.get()
         if value == 'last':
             break
-        elif value == StopIteration:
+        elif value is StopIteration:
             n_stop_iter = n_stop_iter + 1
         elif value == 1:
             n_got = n_got + 1
@@ -224,3 +227,159 @@ def test_cq_maxsize_racy():
     # No items lost
     n_ok_get = n_left_on_queue + n_got
     assert n_ok_get == n_ok_put
+
+
+def test_cq_put_many_get_many():
+    cq = FuzzingClosableQueue(fuzz=0.01)
+    cq.put_many(range(5))
+    cq.close()
+
+    assert cq.get_many(3) == [0, 1, 2]
+    assert cq.get_many() == [3, 4]
+    assert cq.get_many() is StopIteration
+
+
+def test_cq_put_many_maxsize():
+    cq = FuzzingClosableQueue(fuzz=0.001, maxsize=2)
+
+    def putter():
+        cq.put_many(range(10))
+        cq.close()
+
+    w = gevent.spawn(putter)
+
+    got = []
+    while True:
+        batch = cq.get_many()
+        if batch is StopIteration:
+            break
+        got.extend(batch)
+
+    w.join()
+    assert got == list(range(10))
+
+
+@repeat()
+def test_cq_get_many_unstuck():
+    cq = FuzzingClosableQueue(fuzz=0.001)
+
+    workers = [gevent.spawn(cq.get_many, 10) for _ in range(5)]
+    gevent.sleep(0.01)
+    cq.close()
+
+    gevent.joinall(workers)
+    assert all(w.value is StopIteration for w in workers)
+
+
+def test_cq_swap_in():
+    cq = FuzzingClosableQueue(fuzz=0.001, maxsize=1)
+    items = deque([1, 2, 3])
+
+    getter = gevent.spawn(cq.get)
+    gevent.sleep(0.01)
+    cq.swap_in(items)
+    assert getter.get() == 1
+
+    cq.swap_in(deque([4]))
+    assert cq.get_many() == [2, 3, 4]
+
+    # Anything else is copied into a deque
+    cq.swap_in([5, 6])
+    cq.close()
+
+    with pytest.raises(RuntimeError):
+        cq.swap_in(deque([7]))
+
+    assert list(cq) == [5, 6]
+
+
+@repeat()
+def test_cq_close_unsticks_each_getter_once():
+    cq = FuzzingClosableQueue(fuzz=0.001)
+
+    getters = [gevent.spawn(cq.get) for _ in range(20)]
+    gevent.sleep(0.01)
+    cq.close()
+
+    # Getters arriving after close don't wait and don't take anything from the blocked getters
+    assert cq.get() is StopIteration
+
+    gevent.joinall(getters, timeout=1)
+    assert all(g.value is StopIteration for g in getters)
+
+    # No StopIteration is left behind in the queue
+    assert cq.qsize() == 0
+
+
+def test_cq_put_close_unsticks_getter():
+    cq = ClosableQueue()
+
+    # The last put and close in one go, as the last worker of a layer does
+    getters = [gevent.spawn(cq.get) for _ in range(3)]
+    gevent.sleep(0)
+    cq.put(1)
+    cq.close()
+
+    gevent.joinall(getters, timeout=1)
+    assert Counter(g.value for g in getters) == Counter([1, StopIteration, StopIteration])
+
+    assert cq.qsize() == 0
+    assert cq.empty()
+
+
+def test_cpq_order():
+    cpq = ClosablePriorityQueue()
+    values = list(range(20))
+    random.shuffle(values)
+
+    cpq.put_many(values[:10])
+    for v in values[10:]:
+        cpq.put(v)
+
+    assert cpq.get_many(5) == [0, 1, 2, 3, 4]
+
+    with pytest.raises(RuntimeError):
+        cpq.drain_sorted()
+
+    cpq.close()
+    assert cpq.drain_sorted() == list(range(5, 20))
+    assert cpq.get() is StopIteration
+
+
+def test_cpq_put_many_large_heap(monkeypatch):
+    cpq = ClosablePriorityQueue()
+    values = list(range(10000))
+    random.shuffle(values)
+    cpq.put_many(values[:5000])
+
+    # Small batches onto a large heap are pushed, not re-heapified
+    heapify = functools.partial(pytest.fail, "put_many re-heapified the whole heap")
+    monkeypatch.setattr(heapq, 'heapify', heapify)
+    for i in range(5000, 10000, 8):
+        cpq.put_many(values[i:i + 8])
+    monkeypatch.undo()
+
+    cpq.close()
+    assert cpq.drain_sorted() == list(range(10000))
+
+
+def test_cpq_put_many_stopiteration():
+    cpq = ClosablePriorityQueue()
+    cpq.put_many([3, StopIteration, 1])
+    cpq.put(2)
+
+    # StopIteration is handed out once the items are gone
+    assert [cpq.get() for _ in range(4)] == [1, 2, 3, StopIteration]
+    assert cpq.qsize() == 0
+
+
+@repeat()
+def test_cpq_getter_unstuck():
+    cpq = ClosablePriorityQueue()
+
+    getters = [gevent.spawn(cpq.get) for _ in range(5)]
+    gevent.sleep(0.01)
+    cpq.close()
+
+    gevent.joinall(getters, timeout=1)
+    assert all(g.value is StopIteration for g in getters)
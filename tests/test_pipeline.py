@@ -1,46 +1,40 @@
-from gevent_pipeline import Pipeline, ClosableQueue, worker, forward_input
+from gevent_pipeline import Pipeline, ClosableQueue, ClosablePriorityQueue, worker, forward_input
+from helpers import FuzzingClosableQueue
 
 import gevent
 from gevent import queue
 
-import functools
+from collections import Counter
 import itertools
 import pytest
 import random
 
 
-def repeat(n=10):
-    """Used to run racy tests multiple times"""
-    def decorator(f):
-        @functools.wraps(f)
-        def inner(*args, **kwargs):
-            for _ in range(n):
-                last = f(*args, **kwargs)
-            return last
-        return inner
-    return decorator
+# Odd inputs forwarded as is plus even ones doubled:
+# sum(range(1, 100, 2)) + sum(2*i for i in range(0, 100, 2))
+SLOPPY_EXPECTED = 2500 + 4900
 
+# Without fuzz for the fast path, with fuzz to hunt for races
+fuzz_params = pytest.mark.parametrize("fuzz", [None, pytest.param(0.01, marks=pytest.mark.slow)])
 
-def test_worker_raises():
+
+@fuzz_params
+def test_worker_raises(fuzz):
     @worker()
     def f(x):
         if x == 'raise':
             raise ValueError()
         return x
 
-    q_in = ClosableQueue(fuzz=0.01)
-    q_out = ClosableQueue(fuzz=0.01)
-    q_done = queue.Queue()
+    q_in = FuzzingClosableQueue(fuzz=fuzz)
+    q_out = FuzzingClosableQueue(fuzz=fuzz)
 
     q_in.put(0)
     q_in.put('raise')
     q_in.put(1)
 
     with pytest.raises(ValueError):
-        f(q_in, q_out, q_done)
-
-    # Should have signaled done
-    q_done.get_nowait()
+        f(q_in, q_out)
 
     assert q_out.get_nowait() == 0
 
@@ -49,44 +43,63 @@ def test_worker_raises():
         q_out.get_nowait()
 
 
-def test_worker_in_out():
+@fuzz_params
+def test_worker_in_out(fuzz):
     @worker()
     def f(x):
         return x*x
 
-    q_in = ClosableQueue(fuzz=0.01)
-    q_out = ClosableQueue(fuzz=0.01)
-    q_done = queue.Queue()
+    q_in = FuzzingClosableQueue(fuzz=fuzz)
+    q_out = FuzzingClosableQueue(fuzz=fuzz)
 
     for i in range(4):
         q_in.put(i)
     q_in.put(StopIteration)
 
-    f(q_in, q_out, q_done)
+    f(q_in, q_out)
 
-    # Should have signaled done
-    q_done.get_nowait()
+    items = []
+    while True:
+        try:
+            items.append(q_out.get_nowait())
+        except queue.Empty:
+            break
 
-    q_out.put(StopIteration)
-    assert 3*3 + 2*2 + 1 == sum(i for i in q_out)
+    assert items == [0, 1, 4, 9]
 
 
-@repeat(10)
-def test_pipeline():
+def test_worker_no_output():
+    seen = []
 
     @worker()
-    def a(x):
-        return x * 2
+    def f(x):
+        seen.append(x)
 
-    @worker()
-    def b(x):
-        return x + 1
+    q_in = FuzzingClosableQueue(fuzz=0.01)
+    q_in.put_many(range(4))
+    q_in.close()
+
+    f(q_in)
+    assert seen == [0, 1, 2, 3]
+
+
+@worker()
+def a(x):
+    return x * 2
+
+
+@worker()
+def b(x):
+    return x + 1
 
-    def load(q_in):
-        for i in range(10):
-            q_in.put(i)
-        q_in.close()
 
+def load(q_in):
+    q_in.put_many(range(10))
+    q_in.close()
+
+
+@pytest.mark.parametrize("_rep", range(10))
+def test_pipeline(_rep):
     q_in = ClosableQueue()
     q_out = ClosableQueue()
     gevent.spawn(load, q_in)
@@ -95,41 +108,41 @@ def test_pipeline():
         .chain_workers(a, n_workers=3)
         .chain_workers(b, n_workers=3, q_out=q_out))
 
-    assert 100 == sum(i for i in q_out)
+    assert 100 == sum(q_out)
 
 
-def test_pipeline_fold():
+def test_pipeline_fold(max_workers):
     def add(x, y):
-        gevent.sleep(random.uniform(0, 0.001))
+        # Yield to interleave workers, without arming a timer
+        gevent.sleep(0)
         return x + y
 
-    x = (Pipeline()
-         .from_iter(range(0))
-         .fold(add, x0=7))
-    assert x == 7
+    # Independent folds, run them side by side
+    folds = [
+        gevent.spawn(lambda: Pipeline().from_iter(range(0)).fold(add, x0=7)),
+        gevent.spawn(lambda: Pipeline().from_iter(range(10)).fold(add, x0=7, n_workers=min(8, max_workers))),
+        gevent.spawn(lambda: Pipeline().from_iter(range(100)).fold(add, x0=7, n_workers=min(13, max_workers))),
+    ]
+    gevent.joinall(folds, raise_error=True)
 
-    x = (Pipeline()
-         .from_iter(range(10))
-         .fold(add, x0=7, n_workers=8))
-    assert x == 52
+    assert [g.value for g in folds] == [7, 52, 4957]
 
 
-def test_pipeline_fromto_iter():
+def test_pipeline_fromto_iter(max_workers):
     def doubler(x):
-        gevent.sleep(random.uniform(0, 0.001))
+        gevent.sleep(0)
         return x*x
 
     p = Pipeline()\
         .from_iter(range(10))\
-        .map(doubler, n_workers=10)
+        .map(doubler, n_workers=min(10, max_workers))
 
-    l = sorted(p)
-    assert l == [i*i for i in range(10)]
+    assert Counter(p) == Counter(i*i for i in range(10))
 
     p.join()
 
 
-def test_pipeline_sloppy_map():
+def test_pipeline_sloppy_map(max_workers):
     @worker(exception_handler=forward_input)
     def f(x):
         if x & 1:
@@ -139,23 +152,154 @@ def test_pipeline_sloppy_map():
 
     p = (Pipeline()
          .from_iter(range(100))
-         .chain_workers(f, n_workers=10))
+         .chain_workers(f, n_workers=min(10, max_workers)))
 
-    s_odd = sum(range(1, 100, 2))
-    s_even = sum(2*i for i in range(0, 100, 2))
-    assert sum(p) == s_odd + s_even
+    assert sum(p) == SLOPPY_EXPECTED
 
 
-def test_pipeline_filter():
-    bad_values = set((34, 'abc', False))
-    good_values = set((None, 31))
+def test_pipeline_batched():
+    def f(x):
+        if x == 3:
+            raise ValueError()
+        return x * 2
+
+    p = (Pipeline()
+         .from_iter(range(100))
+         .chain_workers(worker(exception_handler=forward_input, batch_size=8)(f), n_workers=4)
+         .filter(lambda x: x % 3, batch_size=8, n_workers=3)
+         .map(lambda x: x + 1, batch_size=8, n_workers=2))
+
+    expected = [x + 1 for x in range(100) for x in [x if x == 3 else x * 2] if x % 3]
+    assert sorted(p) == expected
+
+    x = (Pipeline()
+         .from_iter(range(10))
+         .fold(lambda x, y: x + y, x0=7, n_workers=3, batch_size=4))
+    assert x == 52
 
+
+BAD_VALUES = frozenset({34, 'abc', False})
+GOOD_VALUES = frozenset({None, 31})
+
+
+def test_pipeline_filter():
     def f(x):
-        return x not in bad_values
+        return x not in BAD_VALUES
 
     p = (Pipeline()
-         .from_iter(itertools.chain(bad_values, good_values))
+         .from_iter(itertools.chain(BAD_VALUES, GOOD_VALUES))
          .filter(f))
 
     result = set(p)
-    assert result == good_values
+    assert result == GOOD_VALUES
+
+
+def test_pipeline_join():
+    p = (Pipeline()
+         .from_iter(range(10))
+         .map(lambda x: x, n_workers=3)
+         .chain_workers(worker()(lambda x: None), n_workers=2, q_out=None))
+
+    assert len(p.join()) == 5
+    assert not p._greenlets
+
+
+def test_pipeline_no_workers():
+    assert list(Pipeline().from_iter(range(3)).map(lambda x: x, n_workers=0)) == []
+    assert Pipeline().from_iter(range(3)).fold(max, x0=7, n_workers=0) == 7
+
+
+class Strict:
+    """
+    Refuses to be compared to anything but another Strict
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        if not isinstance(other, Strict):
+            raise TypeError("Cannot compare Strict to {!r}".format(other))
+        return self.value == other.value
+
+    __hash__ = None
+
+
+def test_pipeline_strict_items():
+    def double(x):
+        return Strict(2 * x.value)
+
+    values = [Strict(1), Strict(2)]
+    p = Pipeline().from_iter(values).map(double, n_workers=2).filter(bool).map(double, batch_size=2)
+    assert sorted(x.value for x in p) == [4, 8]
+
+
+def test_pipeline_sort():
+    values = [random.randint(-100, 100) for _ in range(200)]
+
+    def f(x):
+        gevent.sleep(random.uniform(0, 0.001))
+        return x
+
+    for shard_size in (7, 4096):
+        p = (Pipeline()
+             .from_iter(values)
+             .map(f, n_workers=10)
+             .sort(key=abs, reverse=True, shard_size=shard_size))
+        result = list(p)
+        assert sorted(result) == sorted(values)
+        assert [abs(x) for x in result] == sorted(map(abs, values), reverse=True)
+
+
+def test_cpq_out_join_matches_order():
+    @worker()
+    def f(item):
+        i, x = item
+        gevent.sleep(random.uniform(0, 0.001))
+        return i, x * x
+
+    q_out = ClosablePriorityQueue()
+    p = (Pipeline()
+         .from_iter(enumerate(range(50)))
+         .chain_workers(f, n_workers=10, q_out=q_out))
+    p.join()
+
+    assert [x for _, x in q_out.drain_sorted()] == [x * x for x in range(50)]
+
+
+def test_pipeline_from_iter():
+    def generate():
+        for i in range(20):
+            gevent.sleep(random.uniform(0, 0.001))
+            yield i
+
+    def f(x):
+        gevent.sleep(random.uniform(0, 0.001))
+        return x
+
+    p = Pipeline().from_iter(generate()).map(f, n_workers=5)
+    assert sorted(p) == list(range(20))
+
+    p = Pipeline().from_iter(generate(), maxsize=3).map(f, n_workers=5, batch_size=4)
+    assert sorted(p) == list(range(20))
+
+    assert list(Pipeline().from_iter('abc')) == ['a', 'b', 'c']
+
+    # Other workers get a real queue to read from
+    def forward(q_in, q_out):
+        while not q_in.closed or q_in.qsize():
+            value = q_in.get(timeout=1)
+            if value is not StopIteration:
+                q_out.put(value)
+
+    assert list(Pipeline().from_iter(range(5)).chain_workers(forward)) == list(range(5))
+
+    def produce(q_in, q_out):
+        for i in range(5):
+            gevent.sleep(0.001)
+            q_out.put(i)
+
+    # The producer closes its layer right after the last put, while forward waits on it
+    assert list(Pipeline().chain_workers(produce).chain_workers(forward)) == list(range(5))
+
+    with pytest.raises(ValueError):
+        Pipeline(ClosableQueue()).from_iter(range(3))